@@ -6,40 +6,57 @@ from ale_py import ALEInterface, Action
 from argparse import ArgumentParser
 from itertools import count
 import numpy as np
-import os
-import tempfile
+import sys
+from video import video_writer
 
 class BaselineAgent:
-    def __init__(self, rom_path, baseline, turn_limit=None, frame_skip=None, video_path=None):
+    def __init__(self, rom_path, baseline, turn_limit=None, frame_skip=None, video_path=None, random_seed=None):
         self._ale = ALEInterface()
         self._turn_limit = turn_limit
         self._video_path = video_path
         self._baseline = baseline
+        self._rng = np.random.default_rng(random_seed)
 
+        if random_seed is not None:
+            self._ale.setInt("random_seed", random_seed)
         if frame_skip:
             self._ale.setInt("frame_skip", frame_skip)
 
         self._ale.setFloat("repeat_action_probability", 0)
+        self._ale.setBool("sound", False)
+        self._ale.setBool("display_screen", False)
+        self._ale.setBool("color_averaging", False)
         self._ale.loadROM(rom_path)
 
+    def _random_actions(self, action_set):
+        # draw action indices in blocks instead of one PRNG call per frame
+        while True:
+            for a in self._rng.integers(len(action_set), size=1 << 16).tolist():
+                yield action_set[a]
+
     def play(self):
         print("frame_count,score")
         score = 0
-        min_action_set = self._ale.getMinimalActionSet()
+        min_action_set = tuple(self._ale.getMinimalActionSet())
+        random_actions = self._random_actions(min_action_set)
+        log = []
         total_turns = range(self._turn_limit) if self._turn_limit else count()
 
-        with tempfile.TemporaryDirectory() as png_dir:
-            for i in total_turns:
+        height, width = self._ale.getScreenDims()
+
+        with video_writer(self._video_path, height, width) as write_frame:
+            for _ in total_turns:
                 if self._ale.game_over():
                     break
 
-                action = Action.NOOP if self._baseline=="noop" else np.random.choice(min_action_set)
+                action = Action.NOOP if self._baseline=="noop" else next(random_actions)
                 score += self._ale.act(action)
-                self._ale.saveScreenPNG(os.path.join(png_dir, f"frame_{i}.png"))
-                print(self._ale.getFrameNumber(), score)
-                
-            print("score:", score)
-            os.system(f"ffmpeg -framerate 55 -start_number 0 -i {png_dir}/frame_%d.png -pix_fmt yuv420p {self._video_path}")
+                write_frame(self._ale.getScreenRGB())
+                log.append((self._ale.getFrameNumber(), score))
+
+        # one write at the end instead of a line-buffered flush per frame
+        sys.stdout.write("".join(f"{frame} {frame_score}\n" for frame, frame_score in log))
+        print("score:", score)
 
 
 
@@ -51,6 +68,7 @@ if __name__ == "__main__":
         ("baseline", {"type": str, "choices": ["noop", "random"]}),
         ("--frame_skip", {"type": int, "required": True}),
         ("--turn_limit", {"type": int}),
+        ("--random_seed", {"type": int}),
         ("--video_path", {"type": str, "required": True}),
     ]
 
@@ -59,5 +77,5 @@ if __name__ == "__main__":
     
     args = parser.parse_args()
 
-    agent = BaselineAgent(args.rom_path, args.baseline, turn_limit=args.turn_limit, frame_skip=args.frame_skip, video_path=args.video_path)
+    agent = BaselineAgent(args.rom_path, args.baseline, turn_limit=args.turn_limit, frame_skip=args.frame_skip, video_path=args.video_path, random_seed=args.random_seed)
     agent.play()
@@ -0,0 +1,24 @@
+# Shared h264 video writer for ALE screen captures
+
+from contextlib import contextmanager
+import av
+
+VIDEO_CODEC = "h264"
+VIDEO_FPS = 55
+
+@contextmanager
+def video_writer(video_path, height, width):
+    # frames are encoded in-process by libavcodec, no ffmpeg subprocess or pipe
+    with av.open(video_path, mode="w") as container:
+        stream = container.add_stream(VIDEO_CODEC, rate=VIDEO_FPS)
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = "yuv420p"
+
+        def write_frame(rgb):
+            frame = av.VideoFrame.from_ndarray(rgb, format="rgb24")
+            container.mux(stream.encode(frame))
+
+        yield write_frame
+
+        container.mux(stream.encode())